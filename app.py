@@ -1,11 +1,32 @@
 import streamlit as st
+from streamlit import runtime
 import json
+import orjson
 import uuid
-import base64
+import pybase64
+import bisect
+import hashlib
+import math
+import os
+import shutil
+import subprocess
+import tempfile
 from datetime import datetime
-import requests
 import io
-from pydub import AudioSegment
+import itertools
+import threading
+import wave
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import xxhash
+import numpy as np
+import pandas as pd
+import soundfile as sf
+from typing import TYPE_CHECKING
+# pydub and scipy.signal are only needed once audio is decoded or resampled, so they are imported
+# where they are used rather than on every cold start.
+if TYPE_CHECKING:
+    from pydub import AudioSegment
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -15,8 +36,27 @@ st.set_page_config(
 )
 
 # --- App Constants ---
-# Files larger than this will be pre-processed for the player.
-LARGE_FILE_THRESHOLD_MB = 25
+# Segments smaller than this are sent inline as base64; larger ones go through the Files API.
+INLINE_AUDIO_LIMIT_MB = 1
+# generateContent only accepts containerized audio (wav/mp3/aiff/aac/ogg/flac); raw audio/pcm is
+# Live-API only. Segments are therefore sent as WAV, whose 44-byte header is built in-process.
+GEMINI_AUDIO_MIME_TYPE = "audio/wav"
+# Segments are sent to Gemini as mono at this rate: 6-12x fewer bytes than 44.1/48 kHz stereo.
+TRANSCRIPTION_SAMPLE_RATE = 16000
+# Transcription requests run in the background so the page stays responsive; a fragment
+# checks on them at this interval without rerunning the whole page.
+TRANSCRIPTION_WORKERS = 4
+TRANSCRIPTION_POLL_INTERVAL_S = 1.0
+# Number of precomputed waveform peaks handed to the player instead of decoding in the browser.
+WAVEFORM_PEAKS = 8000
+# Formats every major browser plays natively; these are served to the player untouched.
+PLAYER_MIME_TYPES = {"wav": "audio/wav", "mp3": "audio/mpeg", "m4a": "audio/mp4", "flac": "audio/flac", "webm": "audio/webm"}
+PLAYER_OPUS_BITRATE = "16k"
+SEGMENT_TYPES = ["Speech", "Noise", "Music", "Silence"]
+LOUDNESS_LEVELS = ["Normal", "Quiet", "Loud"]
+# Starting row of the speaker details table; blank ID/locale are filled in on submit.
+SPEAKER_DEFAULTS = {"speakerId": "", "gender": "Female", "genderSource": "Annotator", "speakerNativity": "Native", "speakerNativitySource": "Annotator",
+                    "speakerRole": "Customer", "speakerRoleSource": "Annotator", "languageLocale": "", "languageVariety": "", "otherLanguageInfluence": ""}
 
 # --- Initialize Session State ---
 if 'metadata' not in st.session_state:
@@ -31,71 +71,246 @@ if 'current_audio' not in st.session_state:
     st.session_state.current_audio = None
 if 'transcription_content' not in st.session_state:
     st.session_state.transcription_content = ""
+if 'annotation_rev' not in st.session_state:
+    st.session_state.annotation_rev = 0
+# The executor's idle workers exit once the session (and with it the executor) is garbage collected
+if 'executor' not in st.session_state:
+    st.session_state.executor = ThreadPoolExecutor(max_workers=TRANSCRIPTION_WORKERS)
+if 'pending_transcriptions' not in st.session_state:
+    st.session_state.pending_transcriptions = {}
+# Uploads are spooled here; the directory and its files are removed when the session is collected
+if 'upload_dir' not in st.session_state:
+    st.session_state.upload_dir = tempfile.TemporaryDirectory(prefix="audio_annotation_")
 
 # --- Helper Functions ---
 
-def get_json_download_link(data, filename="annotated_data.json"):
-    """Generates a link to download the annotated JSON data."""
-    # FIX: Set ensure_ascii=False to prevent escaping special characters.
-    json_str = json.dumps(data, indent=4, ensure_ascii=False)
-    # FIX: Explicitly encode as 'utf-8' before base64 encoding.
-    b64 = base64.b64encode(json_str.encode('utf-8')).decode()
-    return f'<a href="data:file/json;base64,{b64}" download="{filename}">Download JSON File</a>'
+def save_upload_to_disk(uploaded_file) -> str:
+    """
+    Copies the upload to a file in the session's upload directory and returns its path. Decoders
+    then do buffered reads from disk instead of the session holding another full copy of the bytes.
+    """
+    uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile(delete=False, dir=st.session_state.upload_dir.name, suffix=os.path.splitext(uploaded_file.name)[1]) as f:
+        shutil.copyfileobj(uploaded_file, f)
+    return f.name
 
-def process_audio_for_player(audio_bytes: bytes):
+def discard_audio_files(audio: dict):
+    """Deletes the spooled upload and its player copy once they are replaced."""
+    for path in {audio['path'], audio.get('player_path')}:
+        if path and os.path.exists(path): os.remove(path)
+
+def audio_digest(audio_path: str) -> str:
+    """Returns a short content hash of the audio file, used to key the decoded-audio caches."""
+    # xxh3 hashes at memory bandwidth; the key only needs to tell uploads apart, not resist forgery
+    with open(audio_path, 'rb') as f:
+        return hashlib.file_digest(f, xxhash.xxh3_64).hexdigest()
+
+def decode_audio(audio_path: str) -> "AudioSegment":
     """
-    Optimizes large audio files for the wavesurfer.js player to prevent crashes.
-    Returns the processed audio bytes and the format.
+    Decodes formats libsndfile can't read with pydub/ffmpeg. Not cached: the decoded audio is
+    only reduced by analyze_audio, whose small result is what gets cached.
     """
-    file_size_mb = len(audio_bytes) / (1024 * 1024)
-    
-    if file_size_mb <= LARGE_FILE_THRESHOLD_MB:
-        st.info("Small audio file detected. Using original quality for player.")
-        try:
-            audio = AudioSegment.from_file(io.BytesIO(audio_bytes))
-            buf = io.BytesIO()
-            audio.export(buf, format="wav")
-            return buf.getvalue(), "wav"
-        except Exception:
-             return audio_bytes, "wav"
-    else:
-        st.warning(f"Large file detected ({file_size_mb:.1f} MB). Optimizing for player performance...")
-        with st.spinner("Creating a lightweight audio preview... (This may take a moment)"):
-            try:
-                audio = AudioSegment.from_file(io.BytesIO(audio_bytes))
-                audio = audio.set_channels(1)
-                audio = audio.set_frame_rate(22050)
-                buf = io.BytesIO()
-                audio.export(buf, format="mp3", bitrate="64k")
-                st.success("Optimization complete! Player is now ready.")
-                return buf.getvalue(), "mp3"
-            except Exception as e:
-                st.error(f"Failed to optimize audio file. Error: {e}")
-                return None, None
+    from pydub import AudioSegment
+    return AudioSegment.from_file(audio_path)
+
+_wav_buffers = threading.local()
+
+def pcm_to_wav(pcm, sr: int, ch: int, sw: int) -> io.BytesIO:
+    """
+    Wraps raw little-endian PCM (any bytes-like object) in a WAV container with the stdlib wave
+    module. Each worker thread reuses one buffer, so it is overwritten by that thread's next call.
+    """
+    buf = getattr(_wav_buffers, 'buf', None)
+    if buf is None:
+        buf = _wav_buffers.buf = io.BytesIO()
+    buf.seek(0); buf.truncate()
+    with wave.open(buf, 'wb') as wav:
+        wav.setnchannels(ch)
+        wav.setsampwidth(sw)
+        wav.setframerate(sr)
+        wav.writeframes(pcm)
+    return buf
 
+def decode_pcm(audio_path: str):
+    """
+    Decodes the whole upload into an int16 array of shape (frames, channels) plus the sample rate.
+    WAV/FLAC/OGG/MP3 are read in-process with libsndfile; other formats (m4a, webm) go through
+    pydub, viewed as int16 without copying the samples.
+    """
+    try:
+        return sf.read(audio_path, dtype='int16', always_2d=True)
+    except sf.LibsndfileError:
+        audio = decode_audio(audio_path).set_sample_width(2)
+        pcm = np.frombuffer(audio.raw_data, dtype=np.int16).reshape(-1, audio.channels)
+        return pcm, audio.frame_rate
+
+def peak_dbfs(pcm) -> float:
+    """Peak level of int16 samples in dBFS, as a vectorized NumPy reduction (cf. pydub's max_dBFS)."""
+    # max/min instead of np.abs so -32768 doesn't overflow and no temporary array is allocated
+    peak = max(int(pcm.max()), -int(pcm.min())) if pcm.size else 0
+    return 20 * math.log10(peak / 32768.0) if peak else -math.inf
+
+def to_speech_pcm(pcm, sample_rate: int):
+    """
+    Downmixes int16 samples of shape (frames, channels) to mono and resamples them to
+    TRANSCRIPTION_SAMPLE_RATE, which is all speech recognition needs. resample_poly low-pass
+    filters before decimating, so content above 8 kHz doesn't alias into the speech band.
+    """
+    if pcm.shape[1] == 1 and sample_rate == TRANSCRIPTION_SAMPLE_RATE:
+        return pcm[:, 0]  # Already speech-ready (e.g. 16 kHz mono recordings): no filtering, no copy
+    mono = pcm.mean(axis=1) if pcm.shape[1] > 1 else pcm[:, 0]
+    if sample_rate != TRANSCRIPTION_SAMPLE_RATE:
+        from scipy.signal import resample_poly
+        g = math.gcd(TRANSCRIPTION_SAMPLE_RATE, sample_rate)
+        mono = resample_poly(mono, TRANSCRIPTION_SAMPLE_RATE // g, sample_rate // g)
+    # The filter can overshoot full scale slightly
+    return np.clip(mono, -32768, 32767).astype('<i2')
 
-def transcribe_audio_segment_with_gemini(full_audio_bytes, start_time, end_time, api_key):
+def read_pcm_window(audio: dict, start: float, end: float):
     """
-    Extracts the audio segment from the ORIGINAL high-quality audio bytes.
+    Reads only the [start, end) window of the upload as mono int16 samples at
+    TRANSCRIPTION_SAMPLE_RATE. WAV/FLAC/OGG/MP3 are seeked and read directly by libsndfile;
+    compressed formats are decoded by ffmpeg with an input-side seek (-ss before -i), so neither
+    path decodes the rest of the file. An empty or inverted window yields no samples.
     """
+    # libsndfile treats a negative frame count as "read to EOF"
+    end = max(start, end)
     try:
-        audio = AudioSegment.from_file(io.BytesIO(full_audio_bytes))
-        
-        start_ms = int(float(start_time) * 1000)
-        end_ms = int(float(end_time) * 1000)
-        segment = audio[start_ms:end_ms]
+        with sf.SoundFile(audio['path']) as f:
+            sample_rate = f.samplerate
+            f.seek(min(int(start * sample_rate), f.frames))
+            pcm = f.read(max(0, int((end - start) * sample_rate)), dtype='int16', always_2d=True)
+    except sf.LibsndfileError:
+        # ffmpeg downmixes and resamples while decoding
+        cmd = ['ffmpeg', '-loglevel', 'error', '-ss', f"{start:.3f}", '-t', f"{end - start:.3f}", '-i', audio['path'],
+               '-vn', '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(TRANSCRIPTION_SAMPLE_RATE), 'pipe:1']
+        return np.frombuffer(subprocess.run(cmd, capture_output=True, check=True).stdout, dtype=np.int16)
+    return to_speech_pcm(pcm, sample_rate)
 
-        buf = io.BytesIO()
-        segment.export(buf, format="wav")
-        segment_bytes = buf.getvalue()
-        audio_base64 = base64.b64encode(segment_bytes).decode()
+def sort_segments(segments: list) -> list:
+    """
+    Orders segments by start time. The start values are gathered into a NumPy array once,
+    so the sort compares in C instead of calling a Python key function per comparison pass.
+    """
+    starts = np.fromiter((float(seg.get('start', 0)) for seg in segments), dtype=np.float64, count=len(segments))
+    return [segments[i] for i in np.argsort(starts, kind='stable')]
 
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent?key={api_key}"
-        headers = {'Content-Type': 'application/json'}
+def compute_waveform_peaks(pcm, num_peaks: int = WAVEFORM_PEAKS) -> list:
+    """
+    Reduces int16 samples of shape (frames, channels) to num_peaks buckets and returns each bucket's
+    max and min, interleaved, in the format wavesurfer's peaks expect (the player normalizes them).
+    Every sample falls in a bucket, so the extremes of the result are the extremes of the file.
+    """
+    num_peaks = min(num_peaks, len(pcm))
+    if not num_peaks:
+        return []
+    samples = pcm.reshape(-1)
+    edges = (np.arange(num_peaks) * len(pcm) // num_peaks) * pcm.shape[1]
+    peaks = np.empty(2 * num_peaks, dtype=np.int16)
+    peaks[0::2] = np.maximum.reduceat(samples, edges)
+    peaks[1::2] = np.minimum.reduceat(samples, edges)
+    return peaks.tolist()
 
-        duration = end_time - start_time
-        
-        prompt = f"""You are a strict, expert audio transcription AI. Your single task is to transcribe the provided audio segment with perfect accuracy.
+@st.cache_data(show_spinner=False, ttl=24*60*60)
+def analyze_audio(audio_hash: str, _audio_path: str, num_peaks: int = WAVEFORM_PEAKS) -> dict:
+    """
+    Decodes the upload once and reduces it to the properties-panel values and the player's waveform
+    peaks (int16 max/min pairs). Only this small dict is cached, by content hash and peak count;
+    the decoded samples are freed as soon as it returns.
+    """
+    pcm, sample_rate = decode_pcm(_audio_path)
+    return {"duration_seconds": len(pcm) / sample_rate, "peak_dbfs": peak_dbfs(pcm), "sample_rate": sample_rate,
+            "channels": pcm.shape[1], "peaks": compute_waveform_peaks(pcm, num_peaks)}
+
+def mark_annotation_dirty():
+    """Bumps the annotation revision so the JSON view and segments table are rebuilt on the next render."""
+    st.session_state.annotation_rev += 1
+
+def serialize_annotation(final_json: dict) -> str:
+    """
+    Pretty-prints the annotation with orjson, which keeps non-ASCII characters unescaped.
+    The result is cached per annotation revision, so reruns that don't touch the
+    metadata, speakers or segments reuse the previous string.
+    """
+    cached = st.session_state.get('json_cache')
+    if cached is None or cached[0] != st.session_state.annotation_rev:
+        json_str = orjson.dumps(final_json, option=orjson.OPT_INDENT_2).decode()
+        st.session_state.json_cache = (st.session_state.annotation_rev, json_str)
+    return st.session_state.json_cache[1]
+
+def sniff_audio_format(header: bytes):
+    """
+    Identifies the container from the file's first 12 bytes rather than trusting the upload's
+    extension. Returns a PLAYER_MIME_TYPES key, or None for anything else.
+    """
+    if header[:4] == b'RIFF' and header[8:12] == b'WAVE': return "wav"
+    # MPEG frame sync with a non-zero layer; layer bits 00 are ADTS AAC, which isn't audio/mpeg
+    if header[:3] == b'ID3' or (len(header) > 1 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0 and header[1] & 0x06): return "mp3"
+    if header[:4] == b'fLaC': return "flac"
+    if header[4:8] == b'ftyp': return "m4a"
+    if header[:4] == b'\x1a\x45\xdf\xa3': return "webm"  # EBML (Matroska/WebM)
+    return None
+
+def probe_audio_codec(audio_path: str) -> str:
+    """Returns the first audio stream's codec name as reported by ffprobe (header only), or "" if unknown."""
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=codec_name', '-of', 'csv=p=0', audio_path]
+    try:
+        return subprocess.run(cmd, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def process_audio_for_player(audio_path: str):
+    """
+    Prepares the audio for the wavesurfer.js player. Formats the browser plays natively (detected
+    by magic bytes) are served as uploaded: the MediaElement backend streams them and the waveform
+    comes from precomputed peaks, so no server-side re-encode is needed. Anything else (Ogg, which
+    older Safari can't play, MP4 holding anything but AAC, or unrecognized data such as ADTS AAC)
+    is converted to 16 kbps mono Opus in WebM.
+    Returns the path of the player audio (next to the upload, never in memory) and the format.
+    """
+    with open(audio_path, 'rb') as f:
+        audio_format = sniff_audio_format(f.read(12))
+    # An MP4 container can hold codecs browsers don't decode (e.g. ALAC); only AAC is passed through
+    if audio_format == "m4a" and probe_audio_codec(audio_path) != "aac":
+        audio_format = None
+    if audio_format in PLAYER_MIME_TYPES:
+        return audio_path, audio_format
+    with st.spinner("Creating a browser-compatible audio preview... (This may take a moment)"):
+        # One ffmpeg pass straight from the upload to the player file; no pydub decode
+        player_path = os.path.splitext(audio_path)[0] + ".player.webm"
+        cmd = ['ffmpeg', '-loglevel', 'error', '-y', '-i', audio_path, '-vn', '-ac', '1', '-ar', str(TRANSCRIPTION_SAMPLE_RATE),
+               '-c:a', 'libopus', '-b:a', PLAYER_OPUS_BITRATE, '-f', 'webm', player_path]
+        try:
+            subprocess.run(cmd, capture_output=True, check=True)
+            return player_path, "webm"
+        except Exception as e:
+            st.error(f"Failed to prepare audio for the player. Error: {e}")
+            return None, None
+
+
+@st.cache_resource(show_spinner=False)
+def _gemini_session() -> requests.Session:
+    """Shared HTTP session so repeated Gemini calls reuse the TCP+TLS connection."""
+    session = requests.Session()
+    session.headers['Content-Type'] = 'application/json'
+    # One pooled keep-alive connection per transcription worker
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=TRANSCRIPTION_WORKERS, pool_maxsize=TRANSCRIPTION_WORKERS))
+    return session
+
+def upload_audio_to_gemini(audio_bytes, api_key: str, session: requests.Session, mime_type: str = GEMINI_AUDIO_MIME_TYPE) -> str:
+    """
+    Uploads raw audio bytes (or a file-like object, which is streamed) through the Gemini Files API
+    and returns the file URI. Avoids the 33% base64 inflation and the JSON string copies of inline data.
+    """
+    url = f"https://generativelanguage.googleapis.com/upload/v1beta/files?key={api_key}"
+    headers = {'X-Goog-Upload-Protocol': 'raw', 'Content-Type': mime_type}
+    response = session.post(url, headers=headers, data=audio_bytes, timeout=120)
+    response.raise_for_status()
+    return response.json()['file']['uri']
+
+# --- Gemini Request Templates ---
+# Built once at import; each call only fills in the duration and the audio part.
+TRANSCRIPTION_PROMPT_TEMPLATE = """You are a strict, expert audio transcription AI. Your single task is to transcribe the provided audio segment with perfect accuracy.
 
 **CONTEXT:**
 - You are processing a short audio clip sliced from a longer recording.
@@ -115,38 +330,272 @@ def transcribe_audio_segment_with_gemini(full_audio_bytes, start_time, end_time,
 
 Transcribe the audio now.
 """
-        
-        payload = {
-            "contents": [{"parts": [{"text": prompt}, {"inline_data": {"mime_type": "audio/wav", "data": audio_base64}}]}],
-            "generationConfig": {"temperature": 0.1, "maxOutputTokens": 2000, "topP": 0.8, "topK": 40}
-        }
-
-        with st.spinner(f"Requesting transcription for segment {start_time}s - {end_time}s..."):
-            response = requests.post(url, headers=headers, json=payload, timeout=120)
-
-        if response.status_code == 200:
-            result = response.json()
-            parts = result.get('candidates', [{}])[0].get('content', {}).get('parts', [])
-            if parts:
-                return parts[0].get('text', '').strip()
-            return "[NO_CONTENT]"
-        else:
-            st.error(f"Gemini API Error: {response.status_code} - {response.text}")
-            return None
-    except Exception as e:
-        st.error(f"Error during transcription: {str(e)}")
-        return None
+GEMINI_PAYLOAD_TEMPLATE = {
+    "generationConfig": {"temperature": 0.1, "maxOutputTokens": 2000, "topP": 0.8, "topK": 40}
+}
+
+def transcribe_audio_segment_with_gemini(current_audio, start_time, end_time, api_key, session):
+    """
+    Extracts the audio segment from the ORIGINAL high-quality audio.
+    Runs on the background executor, so it must not call Streamlit (cached functions included):
+    the HTTP session is passed in, and errors are raised and reported when the result is harvested.
+    """
+    # Read just the requested window as 16 kHz mono; the rest of the file is never decoded.
+    pcm_slice = read_pcm_window(current_audio, float(start_time), float(end_time))
+    wav_buf = pcm_to_wav(pcm_slice, TRANSCRIPTION_SAMPLE_RATE, 1, 2)
+
+    if wav_buf.tell() < INLINE_AUDIO_LIMIT_MB * 1024 * 1024:
+        # Encode from a view of the buffer; the view is released before the buffer is reused
+        with wav_buf.getbuffer() as wav_view:
+            audio_part = {"inline_data": {"mime_type": GEMINI_AUDIO_MIME_TYPE, "data": pybase64.b64encode_as_string(wav_view)}}
+    else:
+        wav_buf.seek(0)
+        file_uri = upload_audio_to_gemini(wav_buf, api_key, session)
+        audio_part = {"file_data": {"mime_type": GEMINI_AUDIO_MIME_TYPE, "file_uri": file_uri}}
+
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent?key={api_key}"
+
+    prompt = TRANSCRIPTION_PROMPT_TEMPLATE.format(duration=end_time - start_time)
+    payload = GEMINI_PAYLOAD_TEMPLATE | {"contents": [{"parts": [{"text": prompt}, audio_part]}]}
+
+    response = session.post(url, json=payload, timeout=120)
+
+    if response.status_code == 200:
+        result = response.json()
+        parts = result.get('candidates', [{}])[0].get('content', {}).get('parts', [])
+        if parts:
+            return parts[0].get('text', '').strip()
+        return "[NO_CONTENT]"
+    raise RuntimeError(f"Gemini API Error: {response.status_code} - {response.text}")
+
+@st.cache_resource(show_spinner=False, ttl=24*60*60)
+def transcription_cache() -> dict:
+    """
+    Finished transcriptions by (audio hash, start ms, end ms, API key hash), shared across sessions,
+    so that re-clicking Transcribe on an unchanged range skips the API call. Filled from each
+    future's done-callback, so results survive an interrupted rerun; failures are not stored.
+    """
+    return {}
+
+def transcription_key(audio_hash: str, start: float, end: float, api_key: str) -> tuple:
+    """Cache key for a transcription; times are compared at millisecond precision."""
+    return (audio_hash, round(start * 1000), round(end * 1000), hashlib.blake2b(api_key.encode(), digest_size=8).hexdigest())
+
+def submit_transcription(key: tuple, api_key: str):
+    """
+    Starts the uncached transcription for a cache key on the session's background executor.
+    The result is cached by a done-callback on the worker thread, which only touches the plain dict.
+    """
+    cache = transcription_cache()
+    def store_result(future):
+        if not future.cancelled() and future.exception() is None: cache[key] = future.result()
+    future = st.session_state.executor.submit(transcribe_audio_segment_with_gemini, st.session_state.current_audio, key[1] / 1000.0, key[2] / 1000.0, api_key, _gemini_session())
+    future.add_done_callback(store_result)
+    return future
+
+def reset_transcriptions():
+    """Cancels the transcriptions of the previous audio and starts a fresh executor for the new one."""
+    st.session_state.executor.shutdown(wait=False, cancel_futures=True)
+    st.session_state.executor = ThreadPoolExecutor(max_workers=TRANSCRIPTION_WORKERS)
+    st.session_state.pending_transcriptions = {}
+
+def receive_transcription(start_float: float, end_float: float, transcription: str):
+    """Puts a finished transcription into the segment form and reports it."""
+    if transcription in ["[SILENCE]", "[NOISE]", "[NO_CONTENT]"]: st.info(f"API response: {transcription}"); st.session_state.transcription_content = transcription if transcription == "[NOISE]" else ""
+    else: st.session_state.transcription_content = transcription; st.success(f"✅ Transcribed segment ({start_float}s - {end_float}s) successfully!")
+
+def harvest_transcriptions():
+    """
+    Collects finished background transcriptions into the session state and the transcription cache.
+    Called at the top of every rerun; futures that are still running are left pending.
+    """
+    pending = st.session_state.pending_transcriptions
+    for (start_float, end_float), (key, future) in list(pending.items()):
+        if not future.done():
+            continue
+        del pending[(start_float, end_float)]
+        try:
+            transcription = future.result()
+        except Exception as e:
+            st.error(f"Error during transcription ({start_float}s - {end_float}s): {e}")
+            continue
+        receive_transcription(start_float, end_float, transcription)
+
+@st.fragment(run_every=TRANSCRIPTION_POLL_INTERVAL_S)
+def transcription_poller():
+    """
+    Waits for background transcriptions. Only this fragment reruns on each tick; the page reruns
+    once a result is ready, so harvest_transcriptions can put it into the form.
+    Needs Streamlit >= 1.37: earlier fragment runs dropped the page's media files (player, download).
+    """
+    pending = st.session_state.pending_transcriptions
+    if any(future.done() for _, future in pending.values()): st.rerun()
+    st.info(f"⏳ {len(pending)} transcription(s) in progress...")
+
+def transcribe_pending_segments(api_key: str):
+    """
+    Transcribes every segment whose transcription is still empty. The requests run in parallel on
+    the background executor and each result is written into its segment as it completes. Results
+    are cached as they finish, so if a widget interaction interrupts the batch, clicking again
+    fills the finished segments from the cache.
+    """
+    cache, audio_hash = transcription_cache(), st.session_state.current_audio['hash']
+    jobs, skipped = [], 0
+    for seg in st.session_state.segments:
+        if seg.get('transcriptionData', {}).get('content'): continue
+        # Times edited through the JSON editor may be strings or invalid; such segments are skipped
+        try: jobs.append((seg, transcription_key(audio_hash, *segment_range(seg.get('start'), seg.get('end')), api_key)))
+        except ValueError: skipped += 1
+    if skipped: st.warning(f"Skipped {skipped} segment(s) without a valid start/end range.")
+    if not jobs: st.info("No segments are waiting for a transcription."); return
+    # Split once up front: done-callbacks keep adding to the cache while the batch runs
+    cached, futures = [], {}
+    for seg, key in jobs:
+        if key in cache: cached.append((seg, key, None))
+        else: futures[submit_transcription(key, api_key)] = (seg, key)
+    failures = 0
+    with st.status(f"Transcribing {len(jobs)} segment(s)...", expanded=True) as status:
+        # Ranges transcribed before come straight from the cache; the rest are written as they complete
+        completed = ((*futures[future], future) for future in as_completed(futures))
+        for done, (seg, key, future) in enumerate(itertools.chain(cached, completed), 1):
+            try:
+                transcription = cache[key] if future is None else future.result()
+            except Exception as e:
+                failures += 1; st.write(f"❌ {seg['start']}s - {seg['end']}s: {e}"); continue
+            seg.setdefault('transcriptionData', {})['content'] = "" if transcription in ["[SILENCE]", "[NO_CONTENT]"] else transcription
+            st.write(f"✅ {seg['start']}s - {seg['end']}s ({done}/{len(jobs)})")
+        status.update(label=f"Transcribed {len(jobs) - failures} of {len(jobs)} segment(s)", state="error" if failures else "complete", expanded=bool(failures))
+    mark_annotation_dirty()
+
+def segment_range(start, end) -> tuple:
+    """
+    Validates a segment's start and end (numbers or numeric strings) and returns them as floats.
+    Raises ValueError for empty or non-numeric times and for ranges that aren't 0 <= start < end.
+    """
+    try:
+        start_float, end_float = float(start), float(end)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid start/end times.")
+    # Written as a positive check so NaN is rejected too
+    if not (0 <= start_float < end_float):
+        raise ValueError("Start time must be less than end time and not negative.")
+    return start_float, end_float
+
+def add_segment():
+    """
+    "Add Segment" form callback. Streamlit runs it before the rerun triggered by the submit,
+    so that rerun already renders the new segment and the cleared transcription field.
+    """
+    selected_speaker_id = st.session_state.get('segment_speaker') if st.session_state.speakers else None
+    if not selected_speaker_id:
+        st.toast("Cannot add segment without a speaker.", icon="⚠️"); return
+    try:
+        start_float, end_float = segment_range(st.session_state.start_time_input, st.session_state.end_time_input)
+    except ValueError as e:
+        st.toast(str(e), icon="⚠️"); return
+    lang_code = st.session_state.metadata.get('internalLanguageCode', 'en_US')
+    # Insert in start order so the list never needs re-sorting on rerun; times are kept to ms precision
+    bisect.insort(st.session_state.segments, {"start": round(start_float, 3),"end": round(end_float, 3),"segmentId": str(uuid.uuid4()),"primaryType": st.session_state.segment_primary_type,"loudnessLevel": st.session_state.segment_loudness,"language": lang_code,"segmentLanguages": [lang_code],"speakerId": selected_speaker_id,"transcriptionData": {"content": st.session_state.segment_transcription}}, key=lambda x: float(x.get('start', 0)))
+    mark_annotation_dirty(); st.session_state.transcription_content = ""; st.toast("Segment added!", icon="✅")
+
+def segments_frame() -> pd.DataFrame:
+    """
+    Flattens the segments into the table shown by the segments editor, one row per segment in list
+    order. Rebuilt only when the annotation revision changes.
+    """
+    cached = st.session_state.get('segments_frame_cache')
+    if cached is None or cached[0] != st.session_state.annotation_rev:
+        segments = st.session_state.segments
+        frame = pd.DataFrame({
+            "start": [s.get('start') for s in segments], "end": [s.get('end') for s in segments],
+            "primaryType": [s.get('primaryType') for s in segments], "loudnessLevel": [s.get('loudnessLevel') for s in segments],
+            "speakerId": [s.get('speakerId') for s in segments],
+            "transcription": [s.get('transcriptionData', {}).get('content', '') for s in segments],
+        })
+        st.session_state.segments_frame_cache = (st.session_state.annotation_rev, frame)
+    return st.session_state.segments_frame_cache[1]
+
+def set_segment_fields(segment: dict, edits: dict) -> dict:
+    """
+    Returns a copy of the segment with the edited table cells applied, after the same range check
+    as the "Add Segment" form. Raises ValueError for a cleared or invalid start/end.
+    """
+    segment = segment | {"transcriptionData": dict(segment.get('transcriptionData', {}))}
+    for column, value in edits.items():
+        if column == 'transcription': segment['transcriptionData']['content'] = value or ""
+        else: segment[column] = value
+    start_float, end_float = segment_range(segment.get('start'), segment.get('end'))
+    segment['start'], segment['end'] = round(start_float, 3), round(end_float, 3)
+    return segment
+
+def apply_segment_edits(editor_key: str):
+    """
+    Segments editor on_change callback. Applies the editor's row edits, deletions and additions to
+    the segments list; row numbers refer to the frame the editor was given, which mirrors the list.
+    Bumping the revision gives the next render a fresh editor, so no delta is applied twice.
+    Edits that leave a row without a valid range are reverted and invalid new rows are dropped.
+    """
+    changes, segments = st.session_state[editor_key], st.session_state.segments
+    lang_code = st.session_state.metadata.get('internalLanguageCode', 'en_US')
+    default_speaker = st.session_state.speakers[0]['speakerId'] if st.session_state.speakers else None
+    added, rejected = [], 0
+    for edits in changes['added_rows']:
+        try: added.append(set_segment_fields({"start": None,"end": None,"segmentId": str(uuid.uuid4()),"primaryType": SEGMENT_TYPES[0],"loudnessLevel": LOUDNESS_LEVELS[0],"language": lang_code,"segmentLanguages": [lang_code],"speakerId": default_speaker,"transcriptionData": {"content": ""}}, edits))
+        except ValueError: rejected += 1
+    # A new row that is still being filled in stays in the editor until its start and end are valid
+    if rejected and not (added or changes['edited_rows'] or changes['deleted_rows']): return
+    for row, edits in changes['edited_rows'].items():
+        try: segments[int(row)] = set_segment_fields(segments[int(row)], edits)
+        except ValueError: rejected += 1
+    for row in sorted(changes['deleted_rows'], reverse=True): del segments[row]
+    if rejected: st.warning(f"{rejected} row(s) were not saved: start and end are required, and start must be less than end and not negative.")
+    st.session_state.segments = sort_segments(segments + added); mark_annotation_dirty()
+
+def parse_annotation_json(json_text: str) -> tuple:
+    """
+    Parses the JSON editor's text into (speakers, segments), with segment times checked like the
+    other entry paths, stored as floats and sorted. Raises ValueError (json.JSONDecodeError
+    included) describing the first problem found.
+    """
+    edited_data = json.loads(json_text)
+    value_section = edited_data.get('value', {}) if isinstance(edited_data, dict) else None
+    if not isinstance(value_section, dict): raise ValueError("Expected an object with a 'value' object.")
+    speakers, segments = value_section.get('speakers', []), value_section.get('segments', [])
+    if not isinstance(speakers, list) or not all(isinstance(s, dict) and 'speakerId' in s for s in speakers):
+        raise ValueError("'speakers' must be a list of objects with a 'speakerId'.")
+    if not isinstance(segments, list): raise ValueError("'segments' must be a list.")
+    for i, seg in enumerate(segments, 1):
+        if not isinstance(seg, dict): raise ValueError(f"Segment {i} is not an object.")
+        try: start_float, end_float = segment_range(seg.get('start'), seg.get('end'))
+        except ValueError as e: raise ValueError(f"Segment {i}: {e}")
+        seg['start'], seg['end'] = round(start_float, 3), round(end_float, 3)
+    return speakers, sort_segments(segments)
 
 # =====================================================================================
 # CUSTOM AUDIO PLAYER COMPONENT (UPDATED)
 # =====================================================================================
 
-def audio_player_component(audio_bytes: bytes, audio_format: str = "wav"):
+def player_media_url(audio: dict) -> str:
+    """
+    Registers the player audio with Streamlit's media file manager (the endpoint st.audio serves
+    from) and returns its URL, so the page carries a short URL instead of a base64 data URI.
+    This is not free: like st.audio it must be re-registered on every full rerun to stay alive,
+    and each registration reads and MD5-hashes the whole player file, while Streamlit's in-memory
+    media storage keeps one copy of it for as long as the session uses it. Static file serving
+    would avoid that, but it serves audio as text/plain, which the player can't play.
+    """
+    url = runtime.get_instance().media_file_mgr.add(audio['player_path'], PLAYER_MIME_TYPES[audio['player_format']], f"audio_player.{audio['hash']}")
+    # Relative to the app's base URL, which the srcdoc component iframe inherits
+    return url.lstrip('/')
+
+def audio_player_component(audio_url: str, peaks: list = None, duration: float = None):
     """
     Creates a custom audio player component using wavesurfer.js.
-    Now accepts an audio_format to build the correct data URI.
+    Plays audio_url through the MediaElement backend; when precomputed peaks and the duration are
+    given, the waveform is drawn from them instead of decoding the whole file in the browser.
     """
-    b64_audio = base64.b64encode(audio_bytes).decode()
+    peaks_js = orjson.dumps(peaks).decode() if peaks else "undefined"
+    duration_js = orjson.dumps(duration).decode() if duration else "undefined"
     component_html = f"""
     <div id="waveform-container" style="border: 1px solid #ddd; border-radius: 8px; padding: 20px; width: 90%;">
         <div id="waveform"></div>
@@ -170,9 +619,10 @@ def audio_player_component(audio_bytes: bytes, audio_format: str = "wav"):
             container: '#waveform', waveColor: 'violet', progressColor: 'purple',
             barWidth: 2, barRadius: 3, height: 100, barGap: 3,
             responsive: true, fillParent: true, minPxPerSec: 1,
-            cursorWidth: 1, cursorColor: 'purple'
+            cursorWidth: 1, cursorColor: 'purple', backend: 'MediaElement'
         }});
-        wavesurfer.load('data:audio/{audio_format};base64,{b64_audio}');
+        const peaks = {peaks_js};
+        wavesurfer.load('{audio_url}', peaks && [Float32Array.from(peaks, v => v / 32768)], {duration_js});
         const playBtn = document.getElementById('playBtn');
         const timeDisplay = document.getElementById('time-display');
         const speedSelector = document.getElementById('playbackSpeed');
@@ -200,39 +650,38 @@ def metadata_form():
         st.subheader("2. Language")
         lang_full = st.text_input("Full Language Name", "en_NZ")
         lang_short = st.text_input("Short Name / Symbol", "en_NZ")
-        st.subheader("3. Person in Audio")
-        head_count = st.number_input("Head Count", min_value=1, value=1, step=1)
-        st.subheader("4. Domain")
+        st.subheader("3. Domain")
         domain_name = st.text_input("Domain Name", "Call-center")
         topic_list = st.text_input("Topic List (comma-separated)", "Banking")
-        st.subheader("5. Annotator Info")
+        st.subheader("4. Annotator Info")
         login_encrypted = st.text_input("Login Encrypted (Optional)", "")
         annotator_id = st.text_input("Annotator ID", "t5fb5aa2")
-        st.subheader("6. Convention Info")
+        st.subheader("5. Convention Info")
         master_convention = st.text_input("Master Convention Name", "awsTranscriptionGuidelines_en_US_3.1")
         custom_addendum = st.text_input("Custom Addendum (Optional)", "en_NZ_1.0")
-        st.subheader("7. Speaker Details")
-        speakers_input = []
-        speaker_dominant_varieties_data = []
-        for i in range(int(head_count)):
-            st.markdown(f"**Speaker {i+1}**")
-            speaker_id = st.text_input(f"Speaker ID (leave blank for auto)", key=f"speaker_id_{i}")
-            gender = st.selectbox(f"Gender", ["Female", "Male", "Other"], key=f"gender_{i}")
-            gender_source = st.text_input(f"Gender Source", "Annotator", key=f"gender_source_{i}")
-            speaker_nativity = st.selectbox(f"Speaker Nativity", ["Native", "Non-Native"], key=f"nativity_{i}")
-            speaker_nativity_source = st.text_input(f"Speaker Nativity Source", "Annotator", key=f"nativity_source_{i}")
-            speaker_role = st.text_input(f"Speaker Role", "Customer", key=f"role_{i}")
-            speaker_role_source = st.text_input(f"Speaker Role Source", "Annotator", key=f"role_source_{i}")
-            st.markdown(f"*Speaker Language Info*")
-            language_locale = st.text_input(f"Language Locale", lang_short, key=f"lang_locale_{i}")
-            language_variety = st.text_input(f"Language Variety (comma-separated)", key=f"lang_variety_{i}")
-            other_language_influence = st.text_input(f"Other Language Influence (comma-separated)", key=f"other_lang_influence_{i}")
-            speakers_input.append({"speakerId": speaker_id if speaker_id else str(uuid.uuid4()),"gender": gender,"genderSource": gender_source,"speakerNativity": speaker_nativity,"speakerNativitySource": speaker_nativity_source,"speakerRole": speaker_role,"speakerRoleSource": speaker_role_source,"languages": [language_locale]})
-            if i == 0:
-                 speaker_dominant_varieties_data.append({"languageLocale": language_locale,"languageVariety": [v.strip() for v in language_variety.split(",") if v.strip()],"otherLanguageInfluence": [v.strip() for v in other_language_influence.split(",") if v.strip()]})
+        st.subheader("6. Person in Audio")
+        # One table row per speaker instead of a block of widgets each; add rows for more speakers
+        speakers_frame = st.data_editor(pd.DataFrame([SPEAKER_DEFAULTS]), num_rows="dynamic", hide_index=True, use_container_width=True, key="speakers_editor", column_config={
+            "speakerId": st.column_config.TextColumn("Speaker ID", help="Leave blank for auto"),
+            "gender": st.column_config.SelectboxColumn("Gender", options=["Female", "Male", "Other"]),
+            "genderSource": st.column_config.TextColumn("Gender Source"),
+            "speakerNativity": st.column_config.SelectboxColumn("Speaker Nativity", options=["Native", "Non-Native"]),
+            "speakerNativitySource": st.column_config.TextColumn("Speaker Nativity Source"),
+            "speakerRole": st.column_config.TextColumn("Speaker Role"),
+            "speakerRoleSource": st.column_config.TextColumn("Speaker Role Source"),
+            "languageLocale": st.column_config.TextColumn("Language Locale", help="Defaults to the short language name"),
+            "languageVariety": st.column_config.TextColumn("Language Variety (comma-separated)"),
+            "otherLanguageInfluence": st.column_config.TextColumn("Other Language Influence (comma-separated)"),
+        })
         if st.form_submit_button(label="Save Metadata and Proceed to Annotation"):
+            # Cells left empty (including in added rows) fall back to the defaults
+            rows = [SPEAKER_DEFAULTS | {k: v for k, v in row.items() if v} for row in speakers_frame.fillna("").to_dict('records')]
+            if not rows: st.error("Add at least one speaker."); return
+            speakers_input = [{"speakerId": row['speakerId'] or str(uuid.uuid4()),"gender": row['gender'],"genderSource": row['genderSource'],"speakerNativity": row['speakerNativity'],"speakerNativitySource": row['speakerNativitySource'],"speakerRole": row['speakerRole'],"speakerRoleSource": row['speakerRoleSource'],"languages": [row['languageLocale'] or lang_short]} for row in rows]
+            speaker_dominant_varieties_data = [{"languageLocale": rows[0]['languageLocale'] or lang_short,"languageVariety": [v.strip() for v in rows[0]['languageVariety'].split(",") if v.strip()],"otherLanguageInfluence": [v.strip() for v in rows[0]['otherLanguageInfluence'].split(",") if v.strip()]}]
             st.session_state.metadata = {"type": {"name": type_name, "version": type_version},"languageInfo": {"spokenLanguages": [lang_full], "speakerDominantVarieties": speaker_dominant_varieties_data},"domainInfo": {"domainVersion": "1.0", "domainList": [{"domain": domain_name, "topicList": [t.strip() for t in topic_list.split(',')]}]},"annotatorInfo": {"loginEncrypted": login_encrypted, "annotatorId": annotator_id},"conventionInfo": {"masterConventionName": master_convention, "customAddendum": custom_addendum},"internalLanguageCode": lang_short}
             st.session_state.speakers = speakers_input
+            mark_annotation_dirty()
             st.session_state.page_state = 'annotation'
             st.success("Metadata saved successfully!")
             st.rerun()
@@ -244,42 +693,58 @@ def metadata_form():
 def annotation_page():
     st.title("Step 2: Audio Annotation")
     st.markdown("---")
+    harvest_transcriptions()
     
     uploaded_file = st.file_uploader("Upload an audio file", type=["wav", "mp3", "m4a", "ogg", "flac", "webm"])
 
     if uploaded_file:
+        # Identify the upload without materializing its bytes; file_id changes on every new upload,
+        # so re-uploading a different file under the same name is still picked up.
+        file_sig = uploaded_file.file_id if hasattr(uploaded_file, 'file_id') else uploaded_file.name + str(uploaded_file.size)
         # CORRECTED LINE: Changed the condition to safely check for None
-        if st.session_state.current_audio is None or st.session_state.current_audio.get('name') != uploaded_file.name:
-            # Store the original, high-quality audio bytes in session state
-            st.session_state.current_audio = {'name': uploaded_file.name, 'bytes': uploaded_file.getvalue()}
-            # Process the audio to create a potentially smaller version for the player
-            player_bytes, player_format = process_audio_for_player(st.session_state.current_audio['bytes'])
-            st.session_state.current_audio['player_bytes'] = player_bytes
-            st.session_state.current_audio['player_format'] = player_format
-
-        # Use the original bytes for analysis and properties
-        original_audio_bytes = st.session_state.current_audio['bytes']
-        
-        # Use the (potentially smaller) processed bytes for the player
-        player_audio_bytes = st.session_state.current_audio.get('player_bytes')
+        if st.session_state.current_audio is None or st.session_state.current_audio.get('sig') != file_sig:
+            # Spool the original, high-quality audio to disk and keep only its path in session state
+            audio_path = save_upload_to_disk(uploaded_file)
+            audio_hash = audio_digest(audio_path)
+            if st.session_state.current_audio is not None and st.session_state.current_audio['hash'] == audio_hash:
+                # Same content re-uploaded: keep the prepared player audio and the existing copy on disk
+                os.remove(audio_path)
+                st.session_state.current_audio.update(name=uploaded_file.name, sig=file_sig)
+            else:
+                if st.session_state.current_audio is not None:
+                    reset_transcriptions(); discard_audio_files(st.session_state.current_audio)
+                st.session_state.current_audio = {'name': uploaded_file.name, 'sig': file_sig, 'path': audio_path, 'hash': audio_hash}
+                # Process the audio to create a potentially smaller version for the player
+                player_path, player_format = process_audio_for_player(audio_path)
+                st.session_state.current_audio['player_path'] = player_path
+                st.session_state.current_audio['player_format'] = player_format
+
+        # Use the (potentially smaller) processed audio for the player
+        player_audio_path = st.session_state.current_audio.get('player_path')
         player_audio_format = st.session_state.current_audio.get('player_format')
 
         st.subheader("Audio File Properties (from original file)")
         try:
-            audio_segment = AudioSegment.from_file(io.BytesIO(original_audio_bytes))
-            duration_seconds = len(audio_segment) / 1000.0; peak_loudness_dbfs = audio_segment.max_dBFS; sample_rate_khz = audio_segment.frame_rate / 1000.0; channels = "Stereo" if audio_segment.channels >= 2 else "Mono"
+            metrics = analyze_audio(st.session_state.current_audio['hash'], st.session_state.current_audio['path'])
+            duration_seconds = metrics['duration_seconds']; peak_loudness_dbfs = metrics['peak_dbfs']; sample_rate_khz = metrics['sample_rate'] / 1000.0; channels = "Stereo" if metrics['channels'] >= 2 else "Mono"
             col1, col2, col3, col4 = st.columns(4); col1.metric(label="Duration", value=f"{duration_seconds:.2f} s"); col2.metric(label="Peak Loudness", value=f"{peak_loudness_dbfs:.2f} dBFS"); col3.metric(label="Sample Rate", value=f"{sample_rate_khz:.1f} kHz"); col4.metric(label="Channels", value=channels)
         except Exception as e:
             st.error(f"Could not read audio properties. Error: {e}")
 
         st.subheader("Audio Player")
-        if player_audio_bytes and player_audio_format:
-            # Pass the optimized bytes and format to the player component
-            audio_player_component(player_audio_bytes, player_audio_format)
+        if player_audio_path and player_audio_format:
+            try:
+                analysis = analyze_audio(st.session_state.current_audio['hash'], st.session_state.current_audio['path'])
+                peaks, duration = analysis['peaks'], analysis['duration_seconds']
+            except Exception:
+                # The player can still decode the waveform itself
+                peaks = duration = None
+            # Serve the optimized audio by URL and draw the waveform from the precomputed peaks
+            audio_player_component(player_media_url(st.session_state.current_audio), peaks, duration)
         else:
             st.error("Audio could not be processed for the player.")
         
-        # --- The rest of the page uses original_audio_bytes for transcription ---
+        # --- The rest of the page uses the original audio for transcription ---
         st.subheader("Add a New Segment")
         time_col1, time_col2, transcribe_col = st.columns([2, 2, 1])
         with time_col1: start_time = st.text_input("Start Time (s)", "0.0", key="start_time_input")
@@ -288,56 +753,61 @@ def annotation_page():
             st.markdown("<br>", unsafe_allow_html=True)
             if st.button("🎙️ Transcribe", help="Transcribe this audio segment"):
                 try:
-                    start_float, end_float = float(start_time), float(end_time)
-                    if not(start_float < end_float and start_float >= 0): st.error("Start time must be less than end time and not negative.")
-                    else:
-                        api_key = st.secrets["GEMINI_API_KEY"]
-                        # Pass the ORIGINAL bytes for high-quality transcription
-                        transcription = transcribe_audio_segment_with_gemini(original_audio_bytes, start_float, end_float, api_key)
-                        if transcription is not None:
-                            if transcription in ["[SILENCE]", "[NOISE]", "[NO_CONTENT]"]: st.info(f"API response: {transcription}"); st.session_state.transcription_content = transcription if transcription == "[NOISE]" else ""
-                            else: st.session_state.transcription_content = transcription; st.success(f"✅ Transcribed segment ({start_float}s - {end_float}s) successfully!")
-                            st.rerun()
+                    start_float, end_float = segment_range(start_time, end_time)
+                    api_key = st.secrets["GEMINI_API_KEY"]
+                    key = transcription_key(st.session_state.current_audio['hash'], start_float, end_float, api_key)
+                    pending_id = (key[1] / 1000.0, key[2] / 1000.0)
+                    if key in transcription_cache(): receive_transcription(*pending_id, transcription_cache()[key])
+                    # A range that is already in flight is not submitted again; its result lands on the next harvest
+                    elif pending_id in st.session_state.pending_transcriptions: st.info("This segment is already being transcribed.")
+                    # Transcribe from the ORIGINAL audio for high quality, off the script thread
+                    else: st.session_state.pending_transcriptions[pending_id] = (key, submit_transcription(key, api_key))
                 except (ValueError, KeyError) as e: st.error(f"Error: {e}")
         
         with st.form(key="segment_form", clear_on_submit=True):
-            transcription = st.text_area("Transcription Content", value=st.session_state.transcription_content, help="Use the 'Transcribe' button to auto-fill this field")
+            st.text_area("Transcription Content", value=st.session_state.transcription_content, help="Use the 'Transcribe' button to auto-fill this field", key="segment_transcription")
             c1, c2, c3 = st.columns(3)
-            with c1: primary_type = st.selectbox("Primary Type", ["Speech", "Noise", "Music", "Silence"])
-            with c2: loudness_level = st.selectbox("Loudness Level", ["Normal", "Quiet", "Loud"])
+            with c1: st.selectbox("Primary Type", SEGMENT_TYPES, key="segment_primary_type")
+            with c2: st.selectbox("Loudness Level", LOUDNESS_LEVELS, key="segment_loudness")
             with c3:
-                if st.session_state.speakers: speaker_options = {s['speakerId']: f"Speaker {i+1} ({s.get('speakerRole', 'N/A')})" for i, s in enumerate(st.session_state.speakers)}; selected_speaker_id = st.selectbox("Speaker", options=list(speaker_options.keys()), format_func=lambda x: speaker_options[x])
-                else: st.warning("No speakers defined."); selected_speaker_id = None
-            if st.form_submit_button("Add Segment"):
-                if selected_speaker_id:
-                    try:
-                        start_float, end_float = float(start_time), float(end_time)
-                        if start_float >= end_float: st.error("Start time must be less than end time!")
-                        else:
-                            lang_code = st.session_state.metadata.get('internalLanguageCode', 'en_US')
-                            st.session_state.segments.append({"start": start_float,"end": end_float,"segmentId": str(uuid.uuid4()),"primaryType": primary_type,"loudnessLevel": loudness_level,"language": lang_code,"segmentLanguages": [lang_code],"speakerId": selected_speaker_id,"transcriptionData": {"content": transcription}})
-                            st.session_state.transcription_content = ""; st.success("Segment added!"); st.rerun()
-                    except ValueError: st.error("Invalid start/end times.")
-                else: st.error("Cannot add segment without a speaker.")
+                if st.session_state.speakers: speaker_options = {s['speakerId']: f"Speaker {i+1} ({s.get('speakerRole', 'N/A')})" for i, s in enumerate(st.session_state.speakers)}; st.selectbox("Speaker", options=list(speaker_options.keys()), format_func=lambda x: speaker_options[x], key="segment_speaker")
+                else: st.warning("No speakers defined.")
+            # The callback runs before the rerun triggered by the submit, so no extra st.rerun() is needed
+            st.form_submit_button("Add Segment", on_click=add_segment)
 
     if st.session_state.segments:
         st.subheader("Annotated Segments")
-        st.session_state.segments = sorted(st.session_state.segments, key=lambda x: x.get('start', 0))
-        for i, seg in enumerate(st.session_state.segments):
-            with st.expander(f"Segment {i+1}: {seg['start']}s - {seg['end']}s ({seg['primaryType']})"):
-                st.json(seg)
-                if st.button("Delete Segment", key=f"del_{seg['segmentId']}"): st.session_state.segments = [s for s in st.session_state.segments if s['segmentId'] != seg['segmentId']]; st.rerun()
+        # Segments can exist (e.g. applied as JSON) before any audio is uploaded
+        if st.button("🎙️ Transcribe all pending", help="Transcribe every segment that has no transcription yet", disabled=st.session_state.current_audio is None):
+            try: transcribe_pending_segments(st.secrets["GEMINI_API_KEY"])
+            except KeyError as e: st.error(f"Error: {e}")
+        # One table widget for all segments; the key follows the revision so edits made elsewhere reset it
+        editor_key = f"segments_editor_{st.session_state.annotation_rev}"
+        st.data_editor(segments_frame(), key=editor_key, on_change=apply_segment_edits, args=(editor_key,), num_rows="dynamic", hide_index=True, use_container_width=True, column_config={
+            "start": st.column_config.NumberColumn("Start (s)", min_value=0.0, step=0.001, format="%.3f", required=True),
+            "end": st.column_config.NumberColumn("End (s)", min_value=0.0, step=0.001, format="%.3f", required=True),
+            "primaryType": st.column_config.SelectboxColumn("Primary Type", options=SEGMENT_TYPES, required=True),
+            "loudnessLevel": st.column_config.SelectboxColumn("Loudness Level", options=LOUDNESS_LEVELS, required=True),
+            "speakerId": st.column_config.SelectboxColumn("Speaker", options=[s['speakerId'] for s in st.session_state.speakers]),
+            "transcription": st.column_config.TextColumn("Transcription", width="large"),
+        })
+        if st.toggle("Inspect segments as JSON"): st.json(st.session_state.segments)
 
     if st.session_state.metadata and st.session_state.speakers:
         final_json = {"type": st.session_state.metadata['type'],"value": {"languages": [st.session_state.metadata['internalLanguageCode']],**st.session_state.metadata,"speakers": st.session_state.speakers,"segments": st.session_state.segments,"taskStatus": {"segmentation": {"workflowStatus": "COMPLETE", "workflowType": "LABEL"},"speakerId": {"workflowStatus": "COMPLETE", "workflowType": "LABEL"},"transcription": {"workflowStatus": "COMPLETE", "workflowType": "LABEL"}}}}
         st.subheader("Live JSON Editor")
-        # FIX: Set ensure_ascii=False to display special characters correctly in the text area.
-        edited_json_string = st.text_area("JSON Data", json.dumps(final_json, indent=4, ensure_ascii=False), height=600, key="json_editor")
-        if st.button("Apply JSON Changes"):
-            try:
-                edited_data = json.loads(edited_json_string); value_section = edited_data.get('value', {}); st.session_state.speakers = value_section.get('speakers', []); st.session_state.segments = value_section.get('segments', []); st.success("JSON changes applied!"); st.rerun()
-            except json.JSONDecodeError as e: st.error(f"Invalid JSON format: {e}")
-        st.subheader("Download Final Annotation"); st.markdown(get_json_download_link(final_json, "annotated_data.json"), unsafe_allow_html=True)
+        # The full annotation is only serialized into the page while the editor is open
+        if st.toggle("Edit annotation as JSON", key="show_json_editor"):
+            edited_json_string = st.text_area("JSON Data", serialize_annotation(final_json), height=600, key="json_editor")
+            if st.button("Apply JSON Changes"):
+                try:
+                    st.session_state.speakers, st.session_state.segments = parse_annotation_json(edited_json_string); mark_annotation_dirty(); st.success("JSON changes applied!"); st.rerun()
+                except json.JSONDecodeError as e: st.error(f"Invalid JSON format: {e}")
+                except ValueError as e: st.error(f"Invalid annotation: {e}")
+        st.subheader("Download Final Annotation"); st.download_button("Download JSON File", data=serialize_annotation(final_json), file_name="annotated_data.json", mime="application/json")
+
+    # Watch in-flight transcriptions, including any submitted during this run
+    if st.session_state.pending_transcriptions: transcription_poller()
 
 # =====================================================================================
 # MAIN APP ROUTER